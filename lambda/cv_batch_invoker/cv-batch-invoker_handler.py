@@ -1,12 +1,15 @@
 import json
-import time
+import uuid
 import boto3
 import os
+from datetime import datetime, timezone
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 
-lambda_client = boto3.client("lambda")
+from dispatch_controller import AimdController
+from dispatcher import DispatchStore, dispatch_cvs, RUN_STALE_SECONDS
 
-MAX_REQUESTS_PER_MINUTE = 10
-DELAY_SECONDS = 60
+lambda_client = boto3.client("lambda")
 
 dynamodb = boto3.resource('dynamodb')
 s3 = boto3.client("s3")
@@ -14,6 +17,103 @@ s3 = boto3.client("s3")
 cv_bucket = os.environ.get("CV_BUCKET")
 job_table = dynamodb.Table(os.environ['JOB_POSTINGS_TABLE'])
 
+# Adaptive dispatch is enabled when the stats table is configured, the same
+# policy as cv_processor. Otherwise CVs are paced at the default fixed rate
+dispatch_stats_table_name = os.environ.get("DISPATCH_STATS_TABLE")
+api_key_id = os.environ.get("GEMINI_API_KEY_ID", "default")
+RUN_TTL_SECONDS = 60 * 60
+
+
+def _to_epoch(iso_timestamp):
+    return datetime.fromisoformat(iso_timestamp).replace(tzinfo=timezone.utc).timestamp()
+
+
+def _to_iso(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+class DynamoDispatchStore(DispatchStore):
+    """
+    Dispatch stats of one API key, all under pk KEY#<api_key_id>: sk CONTROLLER
+    for the controller state, RUN#<run_id> for the heartbeats of active runs and
+    OUTCOME#<timestamp>#<uuid> for the outcomes written by cv_processor.
+    """
+
+    def __init__(self, table, key_id):
+        self.table = table
+        self.pk = f"KEY#{key_id}"
+
+    def load_controller(self):
+        result = self.table.get_item(Key={"pk": self.pk, "sk": "CONTROLLER"}, ConsistentRead=True)
+        item = result.get("Item") or {}
+        return (
+            AimdController.from_item(item),
+            int(item.get("version", 0)),
+            int(item.get("updated_at_ms", 0)) / 1000
+        )
+
+    def save_controller(self, controller, version, now):
+        try:
+            self.table.put_item(
+                Item={
+                    "pk": self.pk,
+                    "sk": "CONTROLLER",
+                    **controller.to_item(),
+                    "version": version + 1,
+                    "updated_at_ms": int(now * 1000)
+                },
+                ConditionExpression="attribute_not_exists(pk) OR version = :version",
+                ExpressionAttributeValues={":version": version}
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def fetch_outcomes(self, since):
+        query_args = {
+            "KeyConditionExpression": Key("pk").eq(self.pk) & Key("sk").between(
+                f"OUTCOME#{_to_iso(since)}", "OUTCOME#~"
+            ),
+            "ConsistentRead": True
+        }
+        outcomes = []
+        while True:
+            response = self.table.query(**query_args)
+            for item in response.get("Items", []):
+                outcomes.append({
+                    **item,
+                    "reported_at": _to_epoch(item["sk"].split("#")[1])
+                })
+            if "LastEvaluatedKey" not in response:
+                return outcomes
+            query_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def heartbeat(self, run_id, now):
+        self.table.put_item(Item={
+            "pk": self.pk,
+            "sk": f"RUN#{run_id}",
+            "heartbeat_at": int(now),
+            "expires_at": int(now) + RUN_TTL_SECONDS
+        })
+        response = self.table.query(
+            KeyConditionExpression=Key("pk").eq(self.pk) & Key("sk").begins_with("RUN#"),
+            ConsistentRead=True
+        )
+        runs = [i for i in response.get("Items", []) if int(i["heartbeat_at"]) >= now - RUN_STALE_SECONDS]
+        return max(1, len(runs))
+
+    def finish(self, run_id):
+        self.table.delete_item(Key={"pk": self.pk, "sk": f"RUN#{run_id}"})
+
+
+dispatch_store = (
+    DynamoDispatchStore(dynamodb.Table(dispatch_stats_table_name), api_key_id)
+    if dispatch_stats_table_name else None
+)
+
+
 def lambda_handler(event, context):
     # Get user_id from the event
     claims = event.get("requestContext", {}).get("authorizer", {}).get("claims", {})
@@ -74,31 +174,38 @@ def lambda_handler(event, context):
             "body": json.dumps({"error": "No se encontraron archivos para procesar en el bucket"})
         }
 
-    # Process the CV files in batches
-    for i in range(0, len(cv_files), MAX_REQUESTS_PER_MINUTE):
-        batch = cv_files[i:i + MAX_REQUESTS_PER_MINUTE]
-        print(f"Procesando batch {i // MAX_REQUESTS_PER_MINUTE + 1}: {batch}")
-
-        for key in batch:
-            payload = {
-                "bucket": cv_bucket,
-                "cv_key": key,
-                "job_id": job_id,
-                "user_id": user_id
-            }
-
-            lambda_client.invoke(
-                FunctionName="cv-processor",
-                InvocationType="Event",
-                Payload=json.dumps(payload)
-            )
-            print(f"✅ Invocado cv_processor para: {key}")
+    # Dispatch the CV files at the rate allowed by the controller
+    run_id = str(uuid.uuid4())
 
-        if i + MAX_REQUESTS_PER_MINUTE < len(cv_files):
-            print(f"⏳ Esperando {DELAY_SECONDS} segundos para el próximo batch...")
-            time.sleep(DELAY_SECONDS)
+    def invoke(key):
+        payload = {
+            "bucket": cv_bucket,
+            "cv_key": key,
+            "job_id": job_id,
+            "user_id": user_id,
+            "run_id": run_id
+        }
+        lambda_client.invoke(
+            FunctionName="cv-processor",
+            InvocationType="Event",
+            Payload=json.dumps(payload)
+        )
+
+    result = dispatch_cvs(
+        cv_files, invoke, run_id,
+        store=dispatch_store,
+        remaining_ms=context.get_remaining_time_in_millis if context else None
+    )
+
+    if result["failed"] or result["not_dispatched"]:
+        print(f"⚠️ Run {run_id} incompleto: {len(result['failed'])} fallidos, "
+              f"{len(result['not_dispatched'])} sin enviar")
+        return {
+            "statusCode": 207,
+            "body": json.dumps({"message": "No todos los CVs pudieron ser procesados", **result})
+        }
 
     return {
         "statusCode": 200,
-        "body": json.dumps({"message": "Todos los CVs enviados a procesamiento"})
+        "body": json.dumps({"message": "Todos los CVs enviados a procesamiento", **result})
     }
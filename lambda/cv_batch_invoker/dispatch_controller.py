@@ -0,0 +1,120 @@
+import math
+
+# Default controller limits (requests per minute / concurrent invocations)
+DEFAULT_RATE_PER_MINUTE = 10
+MIN_RATE_PER_MINUTE = 2
+MAX_RATE_PER_MINUTE = 600
+DEFAULT_IN_FLIGHT_LIMIT = 10
+MIN_IN_FLIGHT_LIMIT = 1
+MAX_IN_FLIGHT_LIMIT = 200
+
+# AIMD tuning
+ADDITIVE_STEP_PER_MINUTE = 2
+DECREASE_FACTOR = 0.75
+TARGET_LATENCY_MS = 20000
+# 429s keep arriving for a while after a decrease, from CVs dispatched at the
+# old rate. Ignore them for this many control steps instead of decreasing again
+DECREASE_COOLDOWN_STEPS = 1
+
+
+class AimdController:
+    """
+    Additive-increase / multiplicative-decrease controller for the dispatch
+    rate and in-flight limit of a single Gemini API key.
+
+    It is fed with the outcomes reported by cv_processor since the previous
+    update: any 429 scales the rate and the in-flight limit down by
+    DECREASE_FACTOR, a clean interval with acceptable latency grows them.
+    Until the first 429 the controller is in slow start and doubles them, so
+    a large quota is reached in a few intervals; afterwards it grows them by
+    a fixed step.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE_PER_MINUTE, in_flight_limit=DEFAULT_IN_FLIGHT_LIMIT,
+                 additive_step=ADDITIVE_STEP_PER_MINUTE, decrease_factor=DECREASE_FACTOR,
+                 target_latency_ms=TARGET_LATENCY_MS,
+                 min_rate=MIN_RATE_PER_MINUTE, max_rate=MAX_RATE_PER_MINUTE,
+                 min_in_flight=MIN_IN_FLIGHT_LIMIT, max_in_flight=MAX_IN_FLIGHT_LIMIT,
+                 slow_start=True, cooldown=0):
+        self.additive_step = additive_step
+        self.decrease_factor = decrease_factor
+        self.target_latency_ms = target_latency_ms
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.min_in_flight = min_in_flight
+        self.max_in_flight = max_in_flight
+        self.slow_start = slow_start
+        self.cooldown = cooldown
+        self.rate = self._clamp(float(rate), min_rate, max_rate)
+        self.in_flight_limit = int(self._clamp(int(in_flight_limit), min_in_flight, max_in_flight))
+
+    @staticmethod
+    def _clamp(value, lower, upper):
+        return max(lower, min(upper, value))
+
+    @property
+    def delay_seconds(self):
+        # Spacing between two consecutive invocations at the current rate
+        return 60.0 / self.rate
+
+    def update(self, successes, throttled, latencies_ms=()):
+        """
+        Apply one control step. Returns "decrease", "increase" or "hold".
+        """
+        if throttled > 0 and self.cooldown > 0:
+            self.cooldown -= 1
+            return "hold"
+
+        if throttled > 0:
+            self.slow_start = False
+            self.cooldown = DECREASE_COOLDOWN_STEPS
+            self.rate = self._clamp(self.rate * self.decrease_factor, self.min_rate, self.max_rate)
+            self.in_flight_limit = int(self._clamp(
+                math.floor(self.in_flight_limit * self.decrease_factor),
+                self.min_in_flight, self.max_in_flight
+            ))
+            return "decrease"
+
+        self.cooldown = 0
+        if successes == 0:
+            # No feedback, keep the current limits
+            return "hold"
+
+        if latencies_ms and _percentile(latencies_ms, 90) > self.target_latency_ms:
+            # The API is answering but slowing down, do not push harder
+            return "hold"
+
+        if self.slow_start:
+            self.rate = self._clamp(self.rate * 2, self.min_rate, self.max_rate)
+            self.in_flight_limit = int(self._clamp(self.in_flight_limit * 2, self.min_in_flight, self.max_in_flight))
+        else:
+            self.rate = self._clamp(self.rate + self.additive_step, self.min_rate, self.max_rate)
+            self.in_flight_limit = int(self._clamp(self.in_flight_limit + 1, self.min_in_flight, self.max_in_flight))
+        return "increase"
+
+    def to_item(self):
+        # DynamoDB does not accept floats, store the rate in milli-requests per minute
+        return {
+            "rate_milli": int(round(self.rate * 1000)),
+            "in_flight_limit": self.in_flight_limit,
+            "slow_start": self.slow_start,
+            "cooldown": self.cooldown,
+        }
+
+    @classmethod
+    def from_item(cls, item, **kwargs):
+        if not item:
+            return cls(**kwargs)
+        return cls(
+            rate=int(item.get("rate_milli", DEFAULT_RATE_PER_MINUTE * 1000)) / 1000,
+            in_flight_limit=int(item.get("in_flight_limit", DEFAULT_IN_FLIGHT_LIMIT)),
+            slow_start=bool(item.get("slow_start", True)),
+            cooldown=int(item.get("cooldown", 0)),
+            **kwargs
+        )
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(math.ceil(pct / 100 * len(ordered))) - 1)
+    return ordered[max(index, 0)]
@@ -0,0 +1,241 @@
+import time
+from abc import ABC, abstractmethod
+
+from dispatch_controller import AimdController
+
+# Outcomes are polled often so finished CVs free their in-flight slot quickly,
+# the controller is only updated every CONTROL_INTERVAL_SECONDS
+OUTCOME_POLL_SECONDS = 5
+CONTROL_INTERVAL_SECONDS = 15
+# Outcomes can become visible out of order, every poll re-reads this window
+OUTCOME_OVERLAP_SECONDS = 30
+# A run that has not sent a heartbeat for this long no longer counts as active
+RUN_STALE_SECONDS = 3 * CONTROL_INTERVAL_SECONDS
+IN_FLIGHT_TIMEOUT_SECONDS = 300
+# Without any outcome for this run for this long, stop gating on in-flight CVs
+# and stop waiting for them before returning
+NO_FEEDBACK_SECONDS = 90
+MAX_ATTEMPTS_PER_CV = 3
+# Stop dispatching this long before the Lambda deadline
+DEADLINE_MARGIN_MS = 30000
+
+
+class DispatchStore(ABC):
+    """
+    Shared dispatch stats of one API key. cv-batch-invoker_handler.py backs it
+    with DynamoDB, simulate_dispatch.py with memory.
+    """
+
+    @abstractmethod
+    def load_controller(self):
+        """
+        Returns (controller, version, updated_at) with updated_at in epoch seconds.
+        """
+
+    @abstractmethod
+    def save_controller(self, controller, version, now):
+        """
+        Conditional write on version. Returns False if another run saved first.
+        """
+
+    @abstractmethod
+    def fetch_outcomes(self, since):
+        """
+        Returns the outcomes reported at or after since (epoch seconds), as dicts
+        with "sk", "reported_at", "outcome", "cv_key", "run_id" and "latency_ms".
+        """
+
+    @abstractmethod
+    def heartbeat(self, run_id, now):
+        """
+        Marks run_id as active and returns the number of active runs on the key.
+        """
+
+    @abstractmethod
+    def finish(self, run_id):
+        """
+        Removes run_id from the active runs.
+        """
+
+
+def dispatch_cvs(cv_keys, invoke, run_id, store=None, remaining_ms=None, clock=time.time, sleep=time.sleep):
+    """
+    Calls invoke(cv_key) for every key, paced by the AIMD controller of the API
+    key when a store is given, or at the default controller rate otherwise.
+
+    Pacing is a token bucket refilled at the controller rate whose burst is the
+    in-flight limit, so the first CVs are sent at once: without a store that is
+    up to 10 CVs at once and then 10 per minute.
+
+    The rate and in-flight limit of the key are shared among the runs that are
+    active on it. CVs throttled by Gemini are re-queued up to
+    MAX_ATTEMPTS_PER_CV times. remaining_ms() returns the time left before the
+    Lambda deadline; dispatching stops DEADLINE_MARGIN_MS before it.
+
+    Returns a dict with "dispatched" (number of CVs invoked), "succeeded",
+    "failed" ({"cv_key", "reason"}), "not_dispatched" and "unconfirmed"
+    (invoked but without a reported outcome).
+    """
+    adaptive = store is not None
+    controller = AimdController()
+    active_runs = 1
+    if adaptive:
+        try:
+            controller, _, _ = store.load_controller()
+            active_runs = store.heartbeat(run_id, clock())
+        except Exception as e:
+            print("⚠️ Estadísticas de despacho no disponibles, se usa el ritmo fijo:", str(e))
+            adaptive = False
+
+    pending = list(cv_keys)
+    attempts = {}
+    in_flight = {}
+    timed_out = set()
+    succeeded = []
+    failed = []
+
+    seen = {}
+    successes = throttled = 0
+    latencies = []
+
+    start = clock()
+    since = start - OUTCOME_OVERLAP_SECONDS
+    last_feedback = start
+    tokens = None
+    last_refill = start
+    next_poll = start + OUTCOME_POLL_SECONDS
+    next_control = start + CONTROL_INTERVAL_SECONDS
+    print(f"Run {run_id}: {len(pending)} CVs, adaptive={adaptive}, "
+          f"rate={controller.rate:.1f} req/min, in_flight_limit={controller.in_flight_limit}")
+
+    def handle_outcome(o):
+        nonlocal last_feedback
+        key = o.get("cv_key")
+        if key in in_flight:
+            del in_flight[key]
+        elif key in timed_out:
+            timed_out.discard(key)
+        else:
+            return
+        last_feedback = clock()
+
+        if o.get("outcome") == "success":
+            succeeded.append(key)
+        elif o.get("outcome") == "throttled" and attempts[key] < MAX_ATTEMPTS_PER_CV:
+            print(f"🔁 Reencolando {key} tras 429")
+            pending.append(key)
+        elif o.get("outcome") == "throttled":
+            print(f"❌ {key} descartado tras {attempts[key]} intentos con 429")
+            failed.append({"cv_key": key, "reason": "throttled"})
+        else:
+            print(f"❌ cv_processor falló para {key}")
+            failed.append({"cv_key": key, "reason": "error"})
+
+    try:
+        while True:
+            now = clock()
+            stalled = bool(in_flight) and now - last_feedback > NO_FEEDBACK_SECONDS
+            if not pending and (not adaptive or not in_flight or stalled):
+                if stalled:
+                    print(f"⚠️ Sin resultados desde hace {NO_FEEDBACK_SECONDS}s, "
+                          f"se deja de esperar a {len(in_flight)} CVs")
+                break
+            if remaining_ms is not None and remaining_ms() <= DEADLINE_MARGIN_MS:
+                print(f"⚠️ Límite de tiempo de la Lambda cerca, quedan {len(pending)} CVs sin enviar")
+                break
+
+            if adaptive and now >= next_poll:
+                try:
+                    outcomes = store.fetch_outcomes(since)
+                except Exception as e:
+                    print("⚠️ No se pudieron leer los resultados:", str(e))
+                    outcomes = []
+                if outcomes:
+                    since = max(since, max(o["reported_at"] for o in outcomes) - OUTCOME_OVERLAP_SECONDS)
+                for o in sorted(outcomes, key=lambda o: o["reported_at"]):
+                    if o["sk"] in seen:
+                        continue
+                    seen[o["sk"]] = o["reported_at"]
+                    if o.get("outcome") == "success":
+                        successes += 1
+                        # Fast 429 and error replies would hide a slowing API
+                        if o.get("latency_ms") is not None:
+                            latencies.append(int(o["latency_ms"]))
+                    elif o.get("outcome") == "throttled":
+                        throttled += 1
+                    if o.get("run_id") == run_id:
+                        handle_outcome(o)
+                seen = {sk: at for sk, at in seen.items() if at >= since}
+
+                # Invocations that never reported back stop counting against the limit
+                for key, dispatched_at in list(in_flight.items()):
+                    if now - dispatched_at > IN_FLIGHT_TIMEOUT_SECONDS:
+                        print(f"⚠️ Sin resultado para {key}, se descarta del in-flight")
+                        del in_flight[key]
+                        timed_out.add(key)
+                next_poll = now + OUTCOME_POLL_SECONDS
+
+            if adaptive and now >= next_control:
+                try:
+                    active_runs = store.heartbeat(run_id, now)
+                    shared, version, updated_at = store.load_controller()
+                    # Another active run already applied this interval's outcomes
+                    action = "sync"
+                    if now - updated_at >= 0.9 * CONTROL_INTERVAL_SECONDS:
+                        action = shared.update(successes, throttled, latencies)
+                        if not store.save_controller(shared, version, now):
+                            shared, _, _ = store.load_controller()
+                            action = "sync"
+                    controller = shared
+                    print(f"Control ({action}): {successes} ok, {throttled} 429, {active_runs} runs -> "
+                          f"rate={controller.rate:.1f} req/min, in_flight_limit={controller.in_flight_limit}")
+                except Exception as e:
+                    print("⚠️ No se pudo actualizar el controlador:", str(e))
+                successes = throttled = 0
+                latencies = []
+                next_control = now + CONTROL_INTERVAL_SECONDS
+
+            # Share the key limits among the runs dispatching on it. Without
+            # feedback, keep plain rate pacing instead of gating on in-flight CVs
+            tokens_per_second = controller.rate / active_runs / 60
+            in_flight_limit = max(1, controller.in_flight_limit // active_runs)
+            tokens = in_flight_limit if tokens is None else tokens
+            tokens = min(in_flight_limit, tokens + (now - last_refill) * tokens_per_second)
+            last_refill = now
+            gated = adaptive and not stalled and len(in_flight) >= in_flight_limit
+
+            # Tolerate float rounding, the wake-up below aims at exactly one token
+            if pending and not gated and tokens >= 1 - 1e-9:
+                key = pending.pop(0)
+                if not in_flight:
+                    last_feedback = now
+                invoke(key)
+                attempts[key] = attempts.get(key, 0) + 1
+                if adaptive:
+                    in_flight[key] = now
+                print(f"✅ Invocado cv_processor para: {key}")
+                tokens -= 1
+                continue
+
+            wake_at = []
+            if pending and not gated:
+                wake_at.append(now + (1 - tokens) / tokens_per_second)
+            if adaptive:
+                wake_at += [next_poll, next_control]
+            if remaining_ms is not None:
+                wake_at.append(now + (remaining_ms() - DEADLINE_MARGIN_MS) / 1000)
+            sleep(max(min(wake_at) - now, 0))
+    finally:
+        if adaptive:
+            try:
+                store.finish(run_id)
+            except Exception as e:
+                print("⚠️ No se pudo cerrar el run:", str(e))
+
+    return {
+        "dispatched": len(attempts),
+        "succeeded": succeeded,
+        "failed": failed,
+        "not_dispatched": pending,
+        "unconfirmed": list(in_flight) + sorted(timed_out),
+    }
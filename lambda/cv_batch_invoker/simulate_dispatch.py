@@ -0,0 +1,230 @@
+"""
+Offline simulation of the adaptive dispatch against a fake LLM.
+
+It runs the real dispatch loop (dispatcher.dispatch_cvs) with a simulated
+clock, an in-memory DispatchStore and a fake cv_processor:
+
+- The fake LLM enforces a requests-per-minute quota over a sliding window
+  (answering 429 above it) and slows down when more requests are in flight
+  than it can serve.
+- Outcomes become visible in the store after a random delay, so they can be
+  read out of order, and can be dropped altogether.
+- Handler runs are chained back to back, each one limited to the 15 minutes of
+  a Lambda, sharing the controller state through the store.
+
+Usage:
+    python simulate_dispatch.py
+    python simulate_dispatch.py --quota 300 --minutes 30
+    python simulate_dispatch.py --quota 60 --drop-quota 25 --drop-at 20 --minutes 40
+"""
+import argparse
+import contextlib
+import io
+import random
+from collections import deque
+
+from dispatch_controller import AimdController
+from dispatcher import DispatchStore, dispatch_cvs, DEADLINE_MARGIN_MS, RUN_STALE_SECONDS
+
+LAMBDA_TIMEOUT_SECONDS = 15 * 60
+
+
+class SimClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeLLM:
+    """
+    Above concurrency requests in flight the latency grows linearly, so the
+    LLM can never serve more than concurrency * 60 / base_latency_s req/min.
+    """
+
+    def __init__(self, quota_at, concurrency=20, base_latency_s=6.0, seed=0):
+        self.quota_at = quota_at
+        self.concurrency = concurrency
+        self.base_latency_s = base_latency_s
+        self.accepted = deque()
+        self.in_flight = []
+        self.random = random.Random(seed)
+
+    def capacity_per_minute(self):
+        return self.concurrency * 60 / self.base_latency_s
+
+    def submit(self, now):
+        """
+        Returns ("throttled", latency) when the quota is exhausted, otherwise
+        ("success", latency).
+        """
+        while self.accepted and self.accepted[0] <= now - 60:
+            self.accepted.popleft()
+        self.in_flight = [t for t in self.in_flight if t > now]
+        if len(self.accepted) >= self.quota_at(now):
+            return "throttled", 0.2
+        self.accepted.append(now)
+        slowdown = max(1.0, (len(self.in_flight) + 1) / self.concurrency)
+        latency = self.base_latency_s * slowdown * self.random.uniform(0.8, 1.2)
+        self.in_flight.append(now + latency)
+        return "success", latency
+
+
+class FakeDispatchStore(DispatchStore):
+    def __init__(self, clock, visibility_delay_s=0.0, drop_outcomes=False, seed=0):
+        self.clock = clock
+        self.visibility_delay_s = visibility_delay_s
+        self.drop_outcomes = drop_outcomes
+        self.random = random.Random(seed)
+        self.outcomes = []
+        self.controller_item = None
+        self.version = 0
+        self.updated_at = 0
+        self.runs = {}
+
+    def report(self, outcome, cv_key, run_id, reported_at, latency_ms):
+        # What cv_processor's report_outcome writes, visible after a random delay
+        if self.drop_outcomes:
+            return
+        self.outcomes.append({
+            "sk": f"OUTCOME#{reported_at:.6f}#{len(self.outcomes)}",
+            "reported_at": reported_at,
+            "visible_at": reported_at + self.random.uniform(0, self.visibility_delay_s),
+            "outcome": outcome,
+            "cv_key": cv_key,
+            "run_id": run_id,
+            "latency_ms": latency_ms,
+        })
+
+    def load_controller(self):
+        return AimdController.from_item(self.controller_item), self.version, self.updated_at
+
+    def save_controller(self, controller, version, now):
+        if version != self.version:
+            return False
+        self.controller_item = controller.to_item()
+        self.version += 1
+        self.updated_at = now
+        return True
+
+    def fetch_outcomes(self, since):
+        now = self.clock.time()
+        return [o for o in self.outcomes if o["visible_at"] <= now and o["reported_at"] >= since]
+
+    def heartbeat(self, run_id, now):
+        self.runs[run_id] = now
+        return max(1, sum(1 for at in self.runs.values() if at >= now - RUN_STALE_SECONDS))
+
+    def finish(self, run_id):
+        self.runs.pop(run_id, None)
+
+
+def run_handler(clock, llm, store, cv_keys, run_id, budget_s=LAMBDA_TIMEOUT_SECONDS, completed=None):
+    """
+    One cv_batch_invoker run. completed collects the time of every success.
+    """
+    deadline = clock.time() + budget_s
+
+    def invoke(key):
+        outcome, latency = llm.submit(clock.time())
+        reported_at = clock.time() + latency
+        if completed is not None and outcome == "success":
+            completed.append(reported_at)
+        store.report(outcome, key, run_id, reported_at, int(latency * 1000))
+
+    return dispatch_cvs(
+        cv_keys, invoke, run_id,
+        store=store,
+        remaining_ms=lambda: (deadline - clock.time()) * 1000,
+        clock=clock.time,
+        sleep=clock.sleep
+    )
+
+
+def quota_schedule(quota, drop_quota=None, drop_at_minute=None):
+    if drop_quota is None:
+        return lambda now: quota
+    return lambda now: drop_quota if now >= drop_at_minute * 60 else quota
+
+
+def simulate(quota, minutes, drop_quota=None, drop_at_minute=None, concurrency=20, visibility_delay_s=5.0,
+             drop_outcomes=False, seed=0, quiet=True):
+    """
+    Chains handler runs over an endless backlog for the given number of
+    minutes. Returns (completed per minute, run results, store, llm).
+    """
+    clock = SimClock()
+    llm = FakeLLM(quota_schedule(quota, drop_quota, drop_at_minute), concurrency=concurrency, seed=seed)
+    store = FakeDispatchStore(clock, visibility_delay_s=visibility_delay_s, drop_outcomes=drop_outcomes, seed=seed)
+    completed = []
+    results = []
+
+    with contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+        while clock.time() < minutes * 60:
+            run = len(results)
+            cv_keys = [f"uploads/sim/run{run}/cv{i}.pdf" for i in range(10000)]
+            budget = min(LAMBDA_TIMEOUT_SECONDS, minutes * 60 - clock.time())
+            if budget * 1000 <= DEADLINE_MARGIN_MS:
+                break
+            results.append(run_handler(clock, llm, store, cv_keys, f"run{run}", budget, completed))
+            clock.sleep(1)
+
+    per_minute = [0] * minutes
+    for at in completed:
+        if at < minutes * 60:
+            per_minute[int(at // 60)] += 1
+    return per_minute, results, store, llm
+
+
+def throughput(per_minute, start, end):
+    window = per_minute[start:end]
+    return sum(window) / len(window)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quota", type=int, default=60, help="Fake LLM quota in requests per minute")
+    parser.add_argument("--minutes", type=int, default=40)
+    parser.add_argument("--drop-quota", type=int, default=None, help="Quota after the drop (bad day), off by default")
+    parser.add_argument("--drop-at", type=int, default=20, help="Minute at which the quota drops")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="Requests the fake LLM serves in parallel before slowing down")
+    parser.add_argument("--visibility-delay", type=float, default=5.0,
+                        help="Maximum delay before an outcome is visible in the store, in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    per_minute, results, store, llm = simulate(args.quota, args.minutes, args.drop_quota, args.drop_at,
+                                               args.concurrency, args.visibility_delay, seed=args.seed)
+    quota_at = quota_schedule(args.quota, args.drop_quota, args.drop_at)
+
+    print(f"LLM capacity: {llm.capacity_per_minute():.0f} req/min")
+    print("minute  quota  completed")
+    for minute, count in enumerate(per_minute):
+        print(f"{minute:6d}  {quota_at(minute * 60):5d}  {count:9d}")
+
+    # Steady state: skip the first 5 minutes of each phase
+    phases = [(5, args.minutes)]
+    if args.drop_quota is not None:
+        phases = [(5, args.drop_at), (args.drop_at + 5, args.minutes)]
+    for start, end in phases:
+        if end - start <= 0:
+            continue
+        available = min(quota_at(start * 60), llm.capacity_per_minute())
+        achieved = throughput(per_minute, start, end)
+        print(f"Minutes {start}-{end}: {achieved:.1f} req/min of {available:.0f} available "
+              f"({100 * achieved / available:.0f}%)")
+
+    for i, result in enumerate(results):
+        print(f"Run {i}: dispatched={result['dispatched']}, succeeded={len(result['succeeded'])}, "
+              f"failed={len(result['failed'])}, unconfirmed={len(result['unconfirmed'])}")
+    controller, _, _ = store.load_controller()
+    print(f"Final controller state: rate={controller.rate:.1f} req/min, in_flight_limit={controller.in_flight_limit}")
+
+
+if __name__ == "__main__":
+    main()
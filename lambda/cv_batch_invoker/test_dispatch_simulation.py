@@ -0,0 +1,93 @@
+"""
+Runs the dispatch loop against the fake LLM of simulate_dispatch.py.
+
+    cd lambda/cv_batch_invoker && python -m pytest -q
+"""
+import contextlib
+import io
+import unittest
+
+from dispatcher import DEADLINE_MARGIN_MS, NO_FEEDBACK_SECONDS, OUTCOME_POLL_SECONDS
+from simulate_dispatch import FakeDispatchStore, FakeLLM, SimClock, run_handler, simulate, throughput
+
+
+def run_job(cv_count, quota=30, budget_s=15 * 60, visibility_delay_s=0.0, drop_outcomes=False):
+    clock = SimClock()
+    llm = FakeLLM(lambda now: quota)
+    store = FakeDispatchStore(clock, visibility_delay_s=visibility_delay_s, drop_outcomes=drop_outcomes)
+    cv_keys = [f"uploads/job/cv{i}.pdf" for i in range(cv_count)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = run_handler(clock, llm, store, cv_keys, "run0", budget_s)
+    return cv_keys, result, clock
+
+
+def assert_accounted_once(test, cv_keys, result):
+    buckets = (
+        result["succeeded"]
+        + [f["cv_key"] for f in result["failed"]]
+        + result["not_dispatched"]
+        + result["unconfirmed"]
+    )
+    test.assertEqual(sorted(buckets), sorted(cv_keys))
+
+
+class ConvergenceTest(unittest.TestCase):
+
+    def test_converges_to_quota(self):
+        per_minute, _, _, _ = simulate(quota=60, minutes=30)
+        self.assertGreaterEqual(throughput(per_minute, 5, 30), 0.85 * 60)
+
+    def test_converges_to_large_quota(self):
+        per_minute, _, _, _ = simulate(quota=300, minutes=30, concurrency=50)
+        self.assertGreaterEqual(throughput(per_minute, 5, 30), 0.8 * 300)
+
+    def test_converges_to_llm_capacity_below_quota(self):
+        per_minute, _, _, llm = simulate(quota=300, minutes=30, concurrency=20)
+        self.assertGreaterEqual(throughput(per_minute, 5, 30), 0.9 * llm.capacity_per_minute())
+
+    def test_follows_quota_drop(self):
+        per_minute, _, _, _ = simulate(quota=60, minutes=40, drop_quota=25, drop_at_minute=20)
+        self.assertGreaterEqual(throughput(per_minute, 5, 20), 0.85 * 60)
+        self.assertGreaterEqual(throughput(per_minute, 25, 40), 0.85 * 25)
+        self.assertLessEqual(throughput(per_minute, 25, 40), 25)
+
+
+class DispatchTest(unittest.TestCase):
+
+    def test_out_of_order_outcomes_are_not_lost(self):
+        cv_keys, result, _ = run_job(200, quota=30, visibility_delay_s=30)
+        self.assertEqual(result["not_dispatched"], [])
+        self.assertEqual(result["unconfirmed"], [])
+        assert_accounted_once(self, cv_keys, result)
+
+    def test_paces_at_fixed_rate_without_feedback(self):
+        cv_keys, result, clock = run_job(100, drop_outcomes=True)
+        self.assertEqual(result["dispatched"], 100)
+        # 10 req/min by default, then stop waiting for the in-flight CVs
+        self.assertLessEqual(clock.time(), 99 * 6 + NO_FEEDBACK_SECONDS + OUTCOME_POLL_SECONDS + 1)
+        assert_accounted_once(self, cv_keys, result)
+
+    def test_stops_before_deadline(self):
+        cv_keys, result, clock = run_job(1000, quota=30, budget_s=5 * 60)
+        self.assertLessEqual(clock.time(), 5 * 60 - DEADLINE_MARGIN_MS / 1000)
+        self.assertTrue(result["not_dispatched"])
+        assert_accounted_once(self, cv_keys, result)
+
+    def test_reports_cvs_throttled_on_every_attempt(self):
+        cv_keys, result, _ = run_job(5, quota=0)
+        self.assertEqual(result["failed"], [{"cv_key": key, "reason": "throttled"} for key in cv_keys])
+        assert_accounted_once(self, cv_keys, result)
+
+    def test_shares_rate_with_other_active_runs(self):
+        clock = SimClock()
+        store = FakeDispatchStore(clock)
+        store.runs["other"] = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_handler(clock, FakeLLM(lambda now: 1000), store, ["a", "b"], "run0")
+            invoked_at = [o["reported_at"] - o["latency_ms"] / 1000 for o in store.outcomes]
+        # 10 req/min for the key, split between two runs
+        self.assertAlmostEqual(invoked_at[1] - invoked_at[0], 12, places=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
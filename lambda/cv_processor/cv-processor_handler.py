@@ -1,5 +1,6 @@
 import os
 import json
+import time
 import base64
 import uuid
 import boto3
@@ -8,6 +9,7 @@ import PIL.Image
 from io import BytesIO
 from datetime import datetime
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 
 # Configurations and environment variables
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
@@ -22,6 +24,12 @@ results_table = dynamodb.Table(os.environ["CV_ANALYSIS_RESULTS_TABLE"])
 cv_bucket = os.environ["CV_BUCKET"]
 results_bucket = os.environ["RESULTS_BUCKET"]
 
+# Outcomes of the Gemini calls, read by cv_batch_invoker to adapt its dispatch rate
+dispatch_stats_table_name = os.environ.get("DISPATCH_STATS_TABLE")
+dispatch_stats_table = dynamodb.Table(dispatch_stats_table_name) if dispatch_stats_table_name else None
+api_key_id = os.environ.get("GEMINI_API_KEY_ID", "default")
+OUTCOME_TTL_SECONDS = 24 * 60 * 60
+
 
 def extract_text_from_pdf_bytes(pdf_bytes):
     text = ""
@@ -48,7 +56,31 @@ def image_file_to_bytes(image_bytes):
         return buffer.getvalue()
 
 
+def report_outcome(body, outcome, latency_ms=None):
+    # Called exactly once per invocation, with the final outcome: "success" only
+    # once the result is stored, "throttled" on a Gemini 429, "error" otherwise.
+    # Reporting must never make the evaluation itself fail
+    if dispatch_stats_table is None:
+        return
+    try:
+        item = {
+            "pk": f"KEY#{api_key_id}",
+            "sk": f"OUTCOME#{datetime.utcnow().isoformat()}#{uuid.uuid4()}",
+            "outcome": outcome,
+            "cv_key": body.get("cv_key"),
+            "run_id": body.get("run_id"),
+            "expires_at": int(time.time()) + OUTCOME_TTL_SECONDS
+        }
+        if latency_ms is not None:
+            item["latency_ms"] = latency_ms
+        dispatch_stats_table.put_item(Item=item)
+    except Exception as e:
+        print("⚠️ No se pudo registrar el resultado:", str(e))
+
+
 def lambda_handler(event, context):
+    body = {}
+    gemini_latency_ms = None
     try:
         print("📥 Event:", event)
         # Parse request body
@@ -72,6 +104,7 @@ def lambda_handler(event, context):
         elif ext in ["png", "jpg", "jpeg"]:
             image_bytes = image_file_to_bytes(cv_bytes)
         else:
+            report_outcome(body, "error")
             return {"statusCode": 400, "body": json.dumps({"error": "Formato no soportado"})}
 
         # Get job description from DynamoDB
@@ -81,6 +114,7 @@ def lambda_handler(event, context):
         })
         item = result.get("Item")
         if not item:
+            report_outcome(body, "error")
             return {"statusCode": 404, "body": json.dumps({"error": "Job description no encontrada"})}
 
         job_description = item["description"]
@@ -117,18 +151,25 @@ def lambda_handler(event, context):
     """
 
         # Call Gemini
-        response = model.generate_content(
-            contents=[
-                prompt,
-                {
-                    "inline_data": {
-                        "mime_type": "image/png",
-                        "data": base64.b64encode(image_bytes).decode("utf-8")
+        started_at = time.monotonic()
+        try:
+            response = model.generate_content(
+                contents=[
+                    prompt,
+                    {
+                        "inline_data": {
+                            "mime_type": "image/png",
+                            "data": base64.b64encode(image_bytes).decode("utf-8")
+                        }
                     }
-                }
-            ],
-            generation_config={"response_mime_type": "application/json"},
-        )
+                ],
+                generation_config={"response_mime_type": "application/json"},
+            )
+        except google_exceptions.ResourceExhausted as e:
+            print("⏳ Gemini quota exceeded:", str(e))
+            report_outcome(body, "throttled", int((time.monotonic() - started_at) * 1000))
+            return {"statusCode": 429, "body": json.dumps({"error": "Cuota de Gemini excedida"})}
+        gemini_latency_ms = int((time.monotonic() - started_at) * 1000)
 
         result_json = response.text
         print("✅ Result obtained from Gemini:", result_json)
@@ -136,6 +177,7 @@ def lambda_handler(event, context):
         # Parse result
         parsed = json.loads(result_json)
         if not all(k in parsed for k in ["participant_id", "score", "reasons"]):
+            report_outcome(body, "error", gemini_latency_ms)
             return {
                 "statusCode": 500,
                 "body": json.dumps({"error": "Formato de respuesta inesperado de Gemini"})
@@ -162,6 +204,7 @@ def lambda_handler(event, context):
             "timestamp": datetime.utcnow().isoformat()
         })
 
+        report_outcome(body, "success", gemini_latency_ms)
         return {
             "statusCode": 200,
             "body": json.dumps({
@@ -173,6 +216,7 @@ def lambda_handler(event, context):
 
     except Exception as e:
         print("❌ Error:", str(e))
+        report_outcome(body, "error", gemini_latency_ms)
         return {
             "statusCode": 500,
             "body": json.dumps({"error": str(e)})